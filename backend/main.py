@@ -1,8 +1,23 @@
 import os
-import json
+import re
+import time
 import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from functools import lru_cache
 from dotenv import load_dotenv
-import boto3
+import aioboto3
+from aiobotocore.config import AioConfig
+import faiss
+import numpy as np
+import orjson
+import sqlite_vec
+from rank_bm25 import BM25Okapi
 from fastapi import FastAPI
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -16,6 +31,41 @@ AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 KNOWLEDGE_BASE_ID = os.getenv("KNOWLEDGE_BASE_ID")
 MODEL_ID = os.getenv("MODEL_ID")
+# Bedrock batch inference: S3 bucket for input/output and the IAM role Bedrock assumes
+BATCH_S3_BUCKET = os.getenv("BATCH_S3_BUCKET")
+BATCH_S3_PREFIX = os.getenv("BATCH_S3_PREFIX", "rag-batch")
+BATCH_ROLE_ARN = os.getenv("BATCH_ROLE_ARN")
+# Bedrock rejects batch jobs below a per-model minimum record count
+BATCH_MIN_RECORDS = int(os.getenv("BATCH_MIN_RECORDS", "100"))
+# KB retrievals in flight at once while building batch prompts
+BATCH_RETRIEVE_CONCURRENCY = int(os.getenv("BATCH_RETRIEVE_CONCURRENCY", "8"))
+EMBED_MODEL_ID = os.getenv("EMBED_MODEL_ID", "amazon.titan-embed-text-v2:0")
+EMBED_DIM = int(os.getenv("EMBED_DIM", "1024"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "300"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+# Shared on-disk answer cache; set CACHE_DB_PATH="" to disable
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache.db")
+PERSISTENT_CACHE_TTL = float(os.getenv("PERSISTENT_CACHE_TTL", "3600"))
+KB_CACHE_THRESHOLD = float(os.getenv("KB_CACHE_THRESHOLD", "0.90"))
+KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", "600"))
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "1024"))
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE", "0.4"))
+# When set, queries with no KB match above KB_MIN_SCORE get this reply
+# without an LLM call; otherwise the LLM answers without KB context.
+NO_CONTEXT_ANSWER = os.getenv("NO_CONTEXT_ANSWER", "")
+# A single KB chunk scoring this high (and this short) is returned as the answer as-is
+DIRECT_ANSWER_SCORE = float(os.getenv("DIRECT_ANSWER_SCORE", "0.85"))
+DIRECT_ANSWER_MAX_CHARS = int(os.getenv("DIRECT_ANSWER_MAX_CHARS", "1200"))
+HYBRID_INDEX_SIZE = int(os.getenv("HYBRID_INDEX_SIZE", "5000"))
+HYBRID_MIN_BM25 = float(os.getenv("HYBRID_MIN_BM25", "5.0"))
+HYBRID_MIN_VECTOR = float(os.getenv("HYBRID_MIN_VECTOR", "0.6"))
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "20"))
+SUMMARY_STEP = int(os.getenv("SUMMARY_STEP", "10"))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1024"))
+
+logger = logging.getLogger(__name__)
 
 # ----------------------
 # FastAPI app
@@ -25,20 +75,45 @@ app = FastAPI()
 # ----------------------
 # Clients
 # ----------------------
-bedrock_client = boto3.client(
-    "bedrock-runtime",
+session = aioboto3.Session(
     region_name=AWS_REGION,
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
 )
 
-kb_client = boto3.client(
-    "bedrock-agent-runtime",
-    region_name=AWS_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY,
+# Pooled, kept-alive connections so bursts reuse TLS sessions instead of
+# handshaking per request. AWS closes idle connections after ~20s.
+client_config = AioConfig(
+    max_pool_connections=64,
+    retries={"max_attempts": 2, "mode": "adaptive"},
+    read_timeout=60,
+    connect_timeout=5,
+    connector_args={"keepalive_timeout": 15},
 )
 
+@app.on_event("startup")
+async def open_clients():
+    """Open the async Bedrock clients once and keep them on app.state"""
+    app.state.client_stack = AsyncExitStack()
+    app.state.bedrock = await app.state.client_stack.enter_async_context(
+        session.client("bedrock-runtime", config=client_config)
+    )
+    app.state.kb = await app.state.client_stack.enter_async_context(
+        session.client("bedrock-agent-runtime", config=client_config)
+    )
+    app.state.bedrock_jobs = await app.state.client_stack.enter_async_context(
+        session.client("bedrock", config=client_config)
+    )
+    app.state.s3 = await app.state.client_stack.enter_async_context(
+        session.client("s3", config=client_config)
+    )
+
+@app.on_event("shutdown")
+async def close_clients():
+    await app.state.client_stack.aclose()
+    if persistent_cache is not None:
+        persistent_cache.close()
+
 # ----------------------
 # Pydantic models
 # ----------------------
@@ -49,37 +124,496 @@ class Message(BaseModel):
 class ChatRequest(BaseModel):
     messages: list[Message]
 
+class BatchRequest(BaseModel):
+    queries: list[str]
+
+# ----------------------
+# Semantic cache
+# ----------------------
+class SemanticCache:
+    """In-process cache keyed by query embedding, with LRU eviction and TTL.
+
+    Vectors live in a FAISS inner-product index over L2-normalized embeddings,
+    so search scores are cosine similarities. Entries are scoped to a
+    namespace so answers never leak between unrelated conversations.
+    """
+
+    def __init__(self, dim: int, threshold: float, ttl: float, max_size: int, search_k: int = 8):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.search_k = search_k
+        self._index = faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+        self._entries = OrderedDict()  # id -> (namespace, value, timestamp)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, ids: list):
+        for entry_id in ids:
+            self._entries.pop(entry_id, None)
+        self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def _evict_expired(self, now: float):
+        expired = [i for i, (_, _, ts) in self._entries.items() if now - ts > self.ttl]
+        if expired:
+            self._remove(expired)
+
+    def check(self, vec: np.ndarray, namespace: str = ""):
+        """Return the cached value for the closest match above threshold, else None"""
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            if not self._entries:
+                return None
+            k = min(self.search_k, len(self._entries))
+            scores, ids = self._index.search(vec.reshape(1, -1), k)
+            for score, entry_id in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                entry = self._entries.get(int(entry_id))
+                if entry is None or entry[0] != namespace:
+                    continue
+                self._entries.move_to_end(int(entry_id))
+                return entry[1]
+        return None
+
+    def store(self, vec: np.ndarray, value, namespace: str = ""):
+        """Insert a value, evicting the least recently used entries beyond max_size"""
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vec.reshape(1, -1), np.asarray([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (namespace, value, time.time())
+            overflow = len(self._entries) - self.max_size
+            if overflow > 0:
+                self._remove(list(self._entries.keys())[:overflow])
+
+answer_cache = SemanticCache(
+    dim=EMBED_DIM,
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_size=ANSWER_CACHE_SIZE,
+)
+
+# KB context depends only on the query, so it is shared across conversations
+# and matched more loosely than full answers.
+kb_cache = SemanticCache(
+    dim=EMBED_DIM,
+    threshold=KB_CACHE_THRESHOLD,
+    ttl=KB_CACHE_TTL,
+    max_size=KB_CACHE_SIZE,
+)
+
+class PersistentSemanticCache:
+    """SQLite + sqlite-vec answer cache that survives restarts.
+
+    Every uvicorn worker opens the same database file, so they share hits
+    without a Redis hop. Vectors live in a vec0 table partitioned by
+    namespace, with the write timestamp as a metadata column so the KNN
+    search only sees fresh rows; the query, response and timestamp live in
+    a sidecar table.
+    Methods block, so call them via asyncio.to_thread.
+    """
+
+    def __init__(self, path: str, dim: int, threshold: float, ttl: float):
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._db.enable_load_extension(True)
+        sqlite_vec.load(self._db)
+        self._db.enable_load_extension(False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS cache_vectors USING vec0("
+                f"namespace text partition key, embedding float[{dim}] distance_metric=cosine, "
+                "ts float)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, query TEXT NOT NULL, "
+                "response TEXT NOT NULL, ts REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_entries_ts ON cache_entries (ts)")
+
+    def check(self, vec: np.ndarray, namespace: str = ""):
+        """Return the cached response for the nearest fresh match above threshold, else None"""
+        with self._lock:
+            # TTL is filtered inside the KNN search, so an expired nearest
+            # neighbour can't hide a fresh match
+            row = self._db.execute(
+                "WITH nearest AS ("
+                "SELECT rowid, distance FROM cache_vectors "
+                "WHERE embedding MATCH ? AND k = 1 AND namespace = ? AND ts >= ?) "
+                "SELECT e.response FROM nearest JOIN cache_entries e ON e.id = nearest.rowid "
+                "WHERE nearest.distance <= ?",
+                (vec.tobytes(), namespace, time.time() - self.ttl, 1.0 - self.threshold),
+            ).fetchone()
+        return row[0] if row else None
+
+    def store(self, vec: np.ndarray, value: str, namespace: str = "", query: str = ""):
+        """Insert a response and drop entries older than the TTL"""
+        now = time.time()
+        with self._lock, self._db:
+            expired = self._db.execute(
+                "SELECT id FROM cache_entries WHERE ts < ?", (now - self.ttl,)
+            ).fetchall()
+            if expired:
+                self._db.executemany("DELETE FROM cache_vectors WHERE rowid = ?", expired)
+                self._db.executemany("DELETE FROM cache_entries WHERE id = ?", expired)
+            cur = self._db.execute(
+                "INSERT INTO cache_entries (namespace, query, response, ts) VALUES (?, ?, ?, ?)",
+                (namespace, query, value, now),
+            )
+            self._db.execute(
+                "INSERT INTO cache_vectors (rowid, namespace, embedding, ts) VALUES (?, ?, ?, ?)",
+                (cur.lastrowid, namespace, vec.tobytes(), now),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def open_persistent_cache():
+    """Open the on-disk cache tier; it is optional, so any failure just disables it"""
+    if not CACHE_DB_PATH:
+        return None
+    try:
+        return PersistentSemanticCache(
+            CACHE_DB_PATH,
+            dim=EMBED_DIM,
+            threshold=ANSWER_CACHE_THRESHOLD,
+            ttl=PERSISTENT_CACHE_TTL,
+        )
+    except Exception:
+        logger.warning("Persistent answer cache disabled: could not open %s", CACHE_DB_PATH, exc_info=True)
+        return None
+
+persistent_cache = open_persistent_cache()
+
+async def lookup_answer(query_vec: np.ndarray | None, namespace: str):
+    """Check the in-memory answer cache, then the shared on-disk one"""
+    if query_vec is None:
+        return None
+    cached = answer_cache.check(query_vec, namespace)
+    if cached is None and persistent_cache is not None:
+        # The on-disk tier is optional, so a SQLite error is just a miss
+        try:
+            cached = await asyncio.to_thread(persistent_cache.check, query_vec, namespace)
+        except Exception:
+            logger.warning("Persistent answer cache lookup failed", exc_info=True)
+        if cached is not None:
+            answer_cache.store(query_vec, cached, namespace)
+    return cached
+
+async def save_answer(user_query: str, query_vec: np.ndarray | None, answer: str, namespace: str):
+    if query_vec is None:
+        return
+    answer_cache.store(query_vec, answer, namespace)
+    if persistent_cache is not None:
+        # The answer is already out; a failed write must not fail the request
+        try:
+            await asyncio.to_thread(persistent_cache.store, query_vec, answer, namespace, user_query)
+        except Exception:
+            logger.warning("Persistent answer cache write failed", exc_info=True)
+
+def history_namespace(conversation_history: list[Message]) -> str:
+    """Hash the conversation history so cached answers stay per-conversation"""
+    digest = hashlib.blake2b(digest_size=16)
+    for msg in conversation_history:
+        digest.update(f"{msg.role}\x00{msg.content}\x00".encode())
+    return digest.hexdigest()
+
+# ----------------------
+# Embedding helper
+# ----------------------
+# Exact-match LRU on the normalized query text, so repeated queries never
+# pay for a second Titan round trip.
+_embedding_cache: OrderedDict = OrderedDict()
+
+async def embed_text(text: str) -> np.ndarray:
+    """Embed text with Titan and return an L2-normalized, read-only float32 vector"""
+    response = await app.state.bedrock.invoke_model(
+        modelId=EMBED_MODEL_ID,
+        body=orjson.dumps({"inputText": text, "dimensions": EMBED_DIM, "normalize": True}),
+        contentType="application/json",
+        accept="application/json",
+    )
+    result_json = orjson.loads(await response["body"].read())
+    vec = np.asarray(result_json["embedding"], dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(vec)
+    # Vectors are shared via caches and indexes, so make sure nobody mutates them
+    vec = vec[0]
+    vec.setflags(write=False)
+    return vec
+
+async def embed_query(text: str) -> np.ndarray | None:
+    """Embed a user query, memoized on its normalized text.
+
+    The vector only keys the caches, so an embedding failure returns None and
+    callers treat it as a cache miss instead of failing the request.
+    """
+    key = text.strip().lower()
+    vec = _embedding_cache.get(key)
+    if vec is not None:
+        _embedding_cache.move_to_end(key)
+        return vec
+
+    try:
+        vec = await embed_text(key)
+    except Exception:
+        logger.warning("Query embedding failed, skipping semantic caches", exc_info=True)
+        return None
+    _embedding_cache[key] = vec
+    if len(_embedding_cache) > EMBED_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+    return vec
+
 # ----------------------
 # LLM helper
 # ----------------------
-def generate_llm_answer(prompt: str, max_tokens: int = 1024, temperature: float = 0.5):
-    """Send prompt to the LLM and get a structured response"""
-    payload = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "messages": [{"role": "user", "content": prompt}],
-        "system": "You are a helpful assistant."
-    }
+SYSTEM_PROMPT = "You are a helpful assistant."
+PAYLOAD_SUFFIX = b'}]}'
 
-    response = bedrock_client.invoke_model(
+@lru_cache(maxsize=16)
+def _payload_prefix(max_tokens: int, temperature: float) -> bytes:
+    """Serialize the constant part of the invoke payload once per settings combo"""
+    head = orjson.dumps(
+        {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "system": SYSTEM_PROMPT,
+        }
+    )
+    return head[:-1] + b',"messages":[{"role":"user","content":'
+
+def build_llm_body(prompt: str, max_tokens: int, temperature: float) -> bytes:
+    """Splice the JSON-escaped prompt into the pre-serialized payload skeleton"""
+    return _payload_prefix(max_tokens, temperature) + orjson.dumps(prompt) + PAYLOAD_SUFFIX
+
+async def generate_llm_answer(prompt: str, max_tokens: int = 1024, temperature: float = 0.5):
+    """Send prompt to the LLM and get a structured response"""
+    response = await app.state.bedrock.invoke_model(
         modelId=MODEL_ID,
-        body=json.dumps(payload),
+        body=build_llm_body(prompt, max_tokens, temperature),
         contentType="application/json",
         accept="application/json",
     )
 
-    result_bytes = response["body"].read()
-    result_json = json.loads(result_bytes.decode("utf-8"))
+    result_bytes = await response["body"].read()
+    result_json = orjson.loads(result_bytes)
     if result_json.get("content"):
         return result_json["content"][0].get("text", "")
     return "No response from model."
 
+async def stream_llm_answer(prompt: str, max_tokens: int = 1024, temperature: float = 0.5):
+    """Send prompt to the LLM and yield text deltas as Bedrock streams them"""
+    response = await app.state.bedrock.invoke_model_with_response_stream(
+        modelId=MODEL_ID,
+        body=build_llm_body(prompt, max_tokens, temperature),
+        contentType="application/json",
+        accept="application/json",
+    )
+
+    async for event in response["body"]:
+        chunk = event.get("chunk")
+        if not chunk:
+            continue
+        chunk_json = orjson.loads(chunk["bytes"])
+        if chunk_json.get("type") == "content_block_delta":
+            text = chunk_json.get("delta", {}).get("text", "")
+            if text:
+                yield text
+
+# ----------------------
+# Local hybrid index
+# ----------------------
+def tokenize(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+class LocalHybridIndex:
+    """BM25 + vector index over KB chunks returned by past Bedrock retrievals.
+
+    Strong local matches are served without a Bedrock KB round trip. BM25 and
+    cosine rankings are merged with reciprocal rank fusion. Chunk embeddings
+    are filled in asynchronously, so chunks without one yet rank on BM25 alone.
+
+    Vectors live in a preallocated (max_chunks, dim) matrix, one slot per
+    chunk. The BM25 index is an immutable snapshot, rebuilt at most every
+    rebuild_interval seconds. search() is CPU-bound, so run it via
+    asyncio.to_thread; add() and set_vector() are cheap and lock-protected.
+    """
+
+    def __init__(
+        self,
+        max_chunks: int,
+        dim: int,
+        min_bm25: float,
+        min_vector: float,
+        rrf_k: int = 60,
+        rebuild_interval: float = 5.0,
+    ):
+        self.min_bm25 = min_bm25
+        self.min_vector = min_vector
+        self.rrf_k = rrf_k
+        self.rebuild_interval = rebuild_interval
+        self._chunks = OrderedDict()  # chunk id -> (text, tokens, slot)
+        self._free_slots = list(range(max_chunks - 1, -1, -1))
+        self._vectors = np.zeros((max_chunks, dim), dtype=np.float32)
+        self._has_vec = np.zeros(max_chunks, dtype=bool)
+        # Bumped whenever a slot is reassigned, so snapshots can spot stale slots
+        self._slot_gen = np.zeros(max_chunks, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._snapshot = None  # (texts, slots, slot generations, BM25Okapi)
+        self._dirty = False
+        self._last_rebuild = 0.0
+
+    @staticmethod
+    def chunk_id(text: str) -> str:
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def add(self, texts: list) -> list:
+        """Add chunks and return the ids of the ones not seen before"""
+        new_ids = []
+        with self._lock:
+            for text in texts:
+                chunk_id = self.chunk_id(text)
+                if chunk_id in self._chunks:
+                    self._chunks.move_to_end(chunk_id)
+                    continue
+                if not self._free_slots:
+                    _, (_, _, old_slot) = self._chunks.popitem(last=False)
+                    self._has_vec[old_slot] = False
+                    self._free_slots.append(old_slot)
+                slot = self._free_slots.pop()
+                self._slot_gen[slot] += 1
+                self._chunks[chunk_id] = (text, tokenize(text), slot)
+                new_ids.append(chunk_id)
+            if new_ids:
+                self._dirty = True
+        return new_ids
+
+    def text(self, chunk_id: str):
+        with self._lock:
+            chunk = self._chunks.get(chunk_id)
+        return chunk[0] if chunk else None
+
+    def set_vector(self, chunk_id: str, vec: np.ndarray):
+        with self._lock:
+            chunk = self._chunks.get(chunk_id)
+            if chunk is not None:
+                self._vectors[chunk[2]] = vec
+                self._has_vec[chunk[2]] = True
+
+    def _current_snapshot(self):
+        snapshot = self._snapshot
+        with self._lock:
+            stale = self._dirty and time.monotonic() - self._last_rebuild >= self.rebuild_interval
+        if snapshot is not None and not stale:
+            return snapshot
+        # Only one thread rebuilds; the others keep searching the old snapshot
+        if not self._rebuild_lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            # Texts, slots and generations must be read together, or an add()
+            # reusing a slot in between would pair an old text with a new vector
+            with self._lock:
+                entries = list(self._chunks.values())
+                slots = np.fromiter((slot for _, _, slot in entries), dtype=np.int64, count=len(entries))
+                gens = self._slot_gen[slots]
+                self._dirty = False
+                self._last_rebuild = time.monotonic()
+            if entries:
+                self._snapshot = (
+                    [text for text, _, _ in entries],
+                    slots,
+                    gens,
+                    BM25Okapi([tokens for _, tokens, _ in entries]),
+                )
+            return self._snapshot
+        finally:
+            self._rebuild_lock.release()
+
+    def search(self, query: str, query_vec: np.ndarray, top_k: int) -> list:
+        """Return up to top_k chunk texts, or [] if the local match is weak"""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        snapshot = self._current_snapshot()
+        if snapshot is None:
+            return []
+        texts, slots, gens, bm25 = snapshot
+
+        bm25_scores = bm25.get_scores(tokens)
+        if bm25_scores.max() < self.min_bm25:
+            return []
+
+        n = len(texts)
+        fused = np.zeros(n)
+        fused[np.argsort(-bm25_scores)] += 1.0 / (self.rrf_k + np.arange(1, n + 1))
+
+        with self._lock:
+            with_vec = np.flatnonzero(self._has_vec[slots] & (self._slot_gen[slots] == gens))
+        if with_vec.size:
+            # One matvec over the whole preallocated matrix; no per-search copy
+            sims = (self._vectors @ query_vec)[slots[with_vec]]
+            if sims.max() < self.min_vector:
+                return []
+            order = with_vec[np.argsort(-sims)]
+            fused[order] += 1.0 / (self.rrf_k + np.arange(1, with_vec.size + 1))
+
+        top = [j for j in np.argsort(-fused)[:top_k] if bm25_scores[j] > 0]
+        return [texts[j] for j in top]
+
+local_index = LocalHybridIndex(
+    max_chunks=HYBRID_INDEX_SIZE,
+    dim=EMBED_DIM,
+    min_bm25=HYBRID_MIN_BM25,
+    min_vector=HYBRID_MIN_VECTOR,
+)
+_background_tasks: set = set()
+
+async def embed_chunks(chunk_ids: list):
+    """Fill in vectors for newly indexed chunks"""
+    for chunk_id in chunk_ids:
+        text = local_index.text(chunk_id)
+        if text is None:
+            continue
+        try:
+            local_index.set_vector(chunk_id, await embed_text(text))
+        except Exception:
+            logger.warning("Chunk embedding failed", exc_info=True)
+            return
+
 # ----------------------
 # Knowledge Base helpers
 # ----------------------
-def retrieve_from_kb(query: str, top_k: int = 3):
-    """Query the knowledge base and return top results"""
+async def retrieve_from_kb(query: str, query_vec: np.ndarray | None, top_k: int = 3, use_caches: bool = True):
+    """Query the knowledge base and return (top results as context, direct answer or "")
+
+    query_vec keys the KB cache and the local hybrid index; pass None (failed
+    embedding) to go straight to Bedrock. use_caches=False also keeps the
+    results out of the KB cache and the local index, for bulk traffic.
+    A direct answer is only returned from a live Bedrock retrieval, where
+    the chunk's score was computed against this exact query.
+    """
+    namespace = f"top_k={top_k}"
+    if query_vec is not None and use_caches:
+        cached = kb_cache.check(query_vec, namespace)
+        if cached is not None:
+            return cached, ""
+
+        # Serve from the local hybrid index when it has a strong match
+        texts = await asyncio.to_thread(local_index.search, query, query_vec, top_k)
+        if texts:
+            kb_context = "\n\n".join(f"Document {i+1}: {text}" for i, text in enumerate(texts))
+            # Local matches carry no Bedrock score, so never answer from them directly
+            kb_cache.store(query_vec, kb_context, namespace)
+            return kb_context, ""
+
     req = {
         "knowledgeBaseId": KNOWLEDGE_BASE_ID,
         "retrievalQuery": {"text": query},
@@ -87,25 +621,120 @@ def retrieve_from_kb(query: str, top_k: int = 3):
             "vectorSearchConfiguration": {"numberOfResults": top_k}
         },
     }
-    response = kb_client.retrieve(**req)
-    candidates = response.get("retrievalResults", [])
+    response = await app.state.kb.retrieve(**req)
+    results = [
+        doc for doc in response.get("retrievalResults", [])
+        if "content" in doc and "text" in doc["content"]
+    ]
+    # Low-score chunks only burn input tokens and dilute the answer
+    candidates = [doc for doc in results if doc.get("score", 1.0) >= KB_MIN_SCORE]
+
+    # Only chunks that passed the score filter may later be served locally
+    new_ids = local_index.add([doc["content"]["text"] for doc in candidates]) if use_caches else []
+    if new_ids:
+        task = asyncio.create_task(embed_chunks(new_ids))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     docs = [
         f"Document {i+1}: {doc['content']['text']}"
         for i, doc in enumerate(candidates)
-        if "content" in doc and "text" in doc["content"]
     ]
-    return "\n\n".join(docs)
+    kb_context = "\n\n".join(docs)
 
-def generate_rag_answer(user_query: str, conversation_history: list):
-    """Combine KB retrieval with LLM generation, considering conversation history"""
-    kb_context = retrieve_from_kb(user_query)
-    
-    # Format conversation history - fix the f-string issue
-    newline = "\n"  # Extract newline to variable
-    conversation_text = newline.join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])
+    # FAQ-style hit: one chunk matches so well that it already is the answer
+    direct_answer = ""
+    if candidates:
+        top = max(candidates, key=lambda doc: doc.get("score", 0.0))
+        top_text = top["content"]["text"].strip()
+        if top.get("score", 0.0) >= DIRECT_ANSWER_SCORE and len(top_text) < DIRECT_ANSWER_MAX_CHARS:
+            direct_answer = top_text
+
+    if query_vec is not None and use_caches:
+        # Only the context is shared: a semantically close query must not
+        # inherit this query's chunk as its final answer
+        kb_cache.store(query_vec, kb_context, namespace)
+    return kb_context, direct_answer
+
+# ----------------------
+# History compression
+# ----------------------
+# Summaries of older turns, keyed by the hash of the history prefix they cover.
+# Prefixes are summarized in SUMMARY_STEP increments so each summary builds on
+# the previous one instead of re-reading the whole conversation.
+conversation_summaries: OrderedDict = OrderedDict()
+_summary_tasks: dict = {}
+
+def format_history(messages: list[Message]) -> str:
+    return "\n".join(f"{msg.role}: {msg.content}" for msg in messages)
+
+async def summarize_history(key: str, previous_summary: str, messages: list[Message]):
+    """Fold messages into the previous summary and store the result under key"""
+    prompt = f"""
+### Summary So Far:
+{previous_summary or "(none)"}
+
+### New Messages:
+{format_history(messages)}
+
+### Instructions:
+Update the summary so it captures the facts, questions and decisions from the
+conversation so far. Reply with the summary only, in a few short sentences.
+"""
+    try:
+        summary = await generate_llm_answer(prompt, max_tokens=300, temperature=0.0)
+    except Exception:
+        logger.warning("Conversation summary failed", exc_info=True)
+        return
+    conversation_summaries[key] = summary
+    if len(conversation_summaries) > SUMMARY_CACHE_SIZE:
+        conversation_summaries.popitem(last=False)
+
+def schedule_summary(conversation_history: list[Message], covered: int):
+    """Summarize the first `covered` messages in the background, if not done yet"""
+    key = history_namespace(conversation_history[:covered])
+    if key in conversation_summaries or key in _summary_tasks:
+        return
+    previous_summary = ""
+    start = 0
+    if covered > SUMMARY_STEP:
+        previous_key = history_namespace(conversation_history[:covered - SUMMARY_STEP])
+        if previous_key in conversation_summaries:
+            previous_summary = conversation_summaries[previous_key]
+            start = covered - SUMMARY_STEP
+    task = asyncio.create_task(
+        summarize_history(key, previous_summary, conversation_history[start:covered])
+    )
+    _summary_tasks[key] = task
+    task.add_done_callback(lambda _: _summary_tasks.pop(key, None))
+
+def compress_history(conversation_history: list[Message]):
+    """Split history into (summary of older turns, recent turns to send verbatim)"""
+    if len(conversation_history) <= HISTORY_WINDOW:
+        return "", conversation_history
+
+    covered = (len(conversation_history) - HISTORY_WINDOW) // SUMMARY_STEP * SUMMARY_STEP
+    if covered:
+        schedule_summary(conversation_history, covered)
+
+    # Use the newest summary already available; it is computed asynchronously,
+    # so it may trail the window by a step or two.
+    for n in range(covered, 0, -SUMMARY_STEP):
+        key = history_namespace(conversation_history[:n])
+        if key in conversation_summaries:
+            conversation_summaries.move_to_end(key)
+            return conversation_summaries[key], conversation_history[n:]
+    return "", conversation_history[-HISTORY_WINDOW:]
+
+def build_rag_prompt(user_query: str, kb_context: str, conversation_history: list[Message]):
+    """Build the RAG prompt from KB context and conversation history"""
+    # Sliding window: older turns are replaced by a rolling summary
+    summary, recent_history = compress_history(conversation_history)
+    conversation_text = format_history(recent_history)
+    if summary:
+        conversation_text = f"Summary of earlier conversation: {summary}\n\n{conversation_text}"
     
     # Build the prompt with formatting instructions
-    prompt = f"""
+    return f"""
 ### Knowledge Base:
 {kb_context}
 
@@ -124,30 +753,202 @@ def generate_rag_answer(user_query: str, conversation_history: list):
 
 ### Response:
 """
-    return generate_llm_answer(prompt)
+
+# In-flight requests keyed by (normalized query, history); identical
+# concurrent requests await the same task instead of hitting Bedrock twice.
+_inflight: dict = {}
+
+def inflight_key(user_query: str, namespace: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(user_query.strip().lower().encode())
+    digest.update(namespace.encode())
+    return digest.hexdigest()
+
+async def _generate_rag_answer(user_query: str, conversation_history: list[Message], namespace: str):
+    query_vec = await embed_query(user_query)
+    cached = await lookup_answer(query_vec, namespace)
+    if cached is not None:
+        return cached
+
+    kb_context, direct_answer = await retrieve_from_kb(user_query, query_vec=query_vec)
+    if direct_answer:
+        return direct_answer
+    if not kb_context and NO_CONTEXT_ANSWER:
+        return NO_CONTEXT_ANSWER
+    prompt = build_rag_prompt(user_query, kb_context, conversation_history)
+    answer = await generate_llm_answer(prompt)
+    await save_answer(user_query, query_vec, answer, namespace)
+    return answer
+
+async def generate_rag_answer(user_query: str, conversation_history: list[Message]):
+    """Combine KB retrieval with LLM generation, considering conversation history"""
+    namespace = history_namespace(conversation_history)
+    key = inflight_key(user_query, namespace)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_generate_rag_answer(user_query, conversation_history, namespace))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shield so one caller disconnecting doesn't cancel the work for the others
+    return await asyncio.shield(task)
 
 # ----------------------
 # Streaming helper
 # ----------------------
-async def stream_generator(user_query: str, conversation_history: list):
-    answer = generate_rag_answer(user_query, conversation_history)
-    for word in answer.split():
-        yield word + " "
-        await asyncio.sleep(0.05)
+async def stream_generator(user_query: str, conversation_history: list[Message]):
+    """Retrieve KB context, then relay LLM deltas as soon as Bedrock emits them"""
+    query_vec = await embed_query(user_query)
+    namespace = history_namespace(conversation_history)
+    cached = await lookup_answer(query_vec, namespace)
+    if cached is not None:
+        yield cached
+        return
+
+    kb_context, direct_answer = await retrieve_from_kb(user_query, query_vec=query_vec)
+    if direct_answer:
+        yield direct_answer
+        return
+    if not kb_context and NO_CONTEXT_ANSWER:
+        yield NO_CONTEXT_ANSWER
+        return
+    prompt = build_rag_prompt(user_query, kb_context, conversation_history)
+
+    parts = []
+    async for text in stream_llm_answer(prompt):
+        parts.append(text)
+        yield text
+    if parts:
+        await save_answer(user_query, query_vec, "".join(parts), namespace)
+
+async def sse_events(chunks, max_items: int = 16, max_delay: float = 0.02):
+    """Coalesce text chunks into Server-Sent Events frames.
+
+    Each frame carries a JSON array of chunks and is flushed once it holds
+    max_items chunks or its first chunk has waited max_delay seconds, even
+    if the model pauses before the next chunk.
+    """
+    it = aiter(chunks)
+    buf = []
+    deadline = 0.0
+    # The pending __anext__ is never cancelled on timeout, only awaited again,
+    # so a flush doesn't tear down the upstream stream
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(it))
+            timeout = max(deadline - time.monotonic(), 0.0) if buf else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                try:
+                    chunk = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+                if not buf:
+                    deadline = time.monotonic() + max_delay
+                buf.append(chunk)
+                if len(buf) < max_items and time.monotonic() < deadline:
+                    continue
+            yield b"data: " + orjson.dumps(buf) + b"\n\n"
+            buf = []
+    finally:
+        if pending is not None:
+            pending.cancel()
+    if buf:
+        yield b"data: " + orjson.dumps(buf) + b"\n\n"
+
+# ----------------------
+# Batch helpers
+# ----------------------
+_batch_retrieve_slots = asyncio.Semaphore(BATCH_RETRIEVE_CONCURRENCY)
+
+def split_s3_uri(uri: str):
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+async def submit_batch_job(queries: list[str]) -> str:
+    """Build one RAG prompt per query and submit them as a Bedrock batch inference job"""
+    if not queries:
+        raise ValueError("queries must not be empty")
+    if len(queries) < BATCH_MIN_RECORDS:
+        raise ValueError(f"batch inference needs at least {BATCH_MIN_RECORDS} queries, got {len(queries)}")
+    if not BATCH_S3_BUCKET or not BATCH_ROLE_ARN:
+        raise ValueError("BATCH_S3_BUCKET and BATCH_ROLE_ARN must be set for batch inference")
+
+    async def retrieve(query: str):
+        # Bounded so a backfill doesn't throttle Bedrock for interactive traffic;
+        # no query embedding, and the interactive caches are left untouched
+        async with _batch_retrieve_slots:
+            return await retrieve_from_kb(query, None, use_caches=False)
+
+    retrieved = await asyncio.gather(*(retrieve(query) for query in queries))
+    # Each line is {"recordId": ..., "modelInput": <same body invoke_model gets>}
+    lines = [
+        b'{"recordId":' + orjson.dumps(f"{i:06d}") + b',"modelInput":'
+        + build_llm_body(build_rag_prompt(query, kb_context, []), 1024, 0.5) + b"}"
+        for i, (query, (kb_context, _)) in enumerate(zip(queries, retrieved))
+    ]
+
+    batch_id = uuid.uuid4().hex
+    input_key = f"{BATCH_S3_PREFIX}/{batch_id}/input.jsonl"
+    await app.state.s3.put_object(Bucket=BATCH_S3_BUCKET, Key=input_key, Body=b"\n".join(lines))
+
+    response = await app.state.bedrock_jobs.create_model_invocation_job(
+        jobName=f"rag-batch-{batch_id}",
+        roleArn=BATCH_ROLE_ARN,
+        modelId=MODEL_ID,
+        inputDataConfig={
+            "s3InputDataConfig": {"s3Uri": f"s3://{BATCH_S3_BUCKET}/{input_key}", "s3InputFormat": "JSONL"}
+        },
+        outputDataConfig={
+            "s3OutputDataConfig": {"s3Uri": f"s3://{BATCH_S3_BUCKET}/{BATCH_S3_PREFIX}/{batch_id}/output/"}
+        },
+    )
+    # The job ARN ends in the short job id, which Bedrock also accepts as identifier
+    return response["jobArn"].rsplit("/", 1)[-1]
+
+async def fetch_batch_results(job_id: str):
+    """Return the job status and, once (partially) completed, the answer per record"""
+    job = await app.state.bedrock_jobs.get_model_invocation_job(jobIdentifier=job_id)
+    status = job["status"]
+    if status not in ("Completed", "PartiallyCompleted"):
+        return {"status": status, "message": job.get("message", "")}
+
+    # Bedrock writes <output prefix>/<job id>/<input file name>.out
+    _, input_key = split_s3_uri(job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"])
+    bucket, output_prefix = split_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+    output_key = f"{output_prefix.rstrip('/')}/{job_id}/{input_key.rsplit('/', 1)[-1]}.out"
+    obj = await app.state.s3.get_object(Bucket=bucket, Key=output_key)
+    body = await obj["Body"].read()
+
+    results = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        output = record.get("modelOutput") or {}
+        if output.get("content"):
+            results.append({"recordId": record["recordId"], "response": output["content"][0].get("text", "")})
+        else:
+            results.append({"recordId": record["recordId"], "error": record.get("error", "No response from model.")})
+    results.sort(key=lambda r: r["recordId"])
+    return {"status": status, "message": job.get("message", ""), "results": results}
 
 # ----------------------
 # API endpoints
 # ----------------------
 @app.post("/rag/query")
-def rag_query_endpoint(request: ChatRequest):
+async def rag_query_endpoint(request: ChatRequest):
     try:
         # Extract conversation history from messages (excluding the last user message)
-        conversation_history = [{"role": msg.role, "content": msg.content} for msg in request.messages[:-1]]
+        conversation_history = request.messages[:-1]
         
         user_message = request.messages[-1].content
 
         # Call the RAG model to get the response
-        answer = generate_rag_answer(user_message, conversation_history)
+        answer = await generate_rag_answer(user_message, conversation_history)
 
         return {"response": answer}
     except Exception as e:
@@ -156,8 +957,29 @@ def rag_query_endpoint(request: ChatRequest):
 @app.post("/rag/stream")
 async def rag_stream_endpoint(request: ChatRequest):
     # Extract conversation history from messages (excluding the last user message)
-    conversation_history = [{"role": msg.role, "content": msg.content} for msg in request.messages[:-1]]
+    conversation_history = request.messages[:-1]
     
     user_message = request.messages[-1].content
 
-    return StreamingResponse(stream_generator(user_message, conversation_history), media_type="text/plain")
\ No newline at end of file
+    return StreamingResponse(
+        sse_events(stream_generator(user_message, conversation_history)),
+        media_type="text/event-stream",
+        # Keep nginx & co. from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/rag/batch")
+async def rag_batch_endpoint(request: BatchRequest):
+    try:
+        # Bulk/offline queries go through Bedrock batch inference instead of real-time calls
+        job_id = await submit_batch_job(request.queries)
+        return {"job_id": job_id}
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.get("/rag/batch/{job_id}")
+async def rag_batch_status_endpoint(job_id: str):
+    try:
+        return await fetch_batch_results(job_id)
+    except Exception as e:
+        return {"error": str(e)}
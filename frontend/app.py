@@ -1,6 +1,7 @@
 import streamlit as st
-import requests
+import httpx
 import json
+import orjson
 import os
 from typing import List, Dict
 import time
@@ -29,27 +30,22 @@ st.set_page_config(
 # ----------------------
 def format_messages_for_api(messages: List[Dict[str, str]]) -> Dict:
     """Format chat messages for the API"""
-    api_messages = []
-    for msg in messages:
-        api_messages.append({
-            "role": msg["role"],
-            "content": msg["content"]
-        })
-    return {"messages": api_messages}
+    # Session messages are already {"role", "content"} dicts
+    return {"messages": messages}
 
 def send_query(messages: List[Dict[str, str]]) -> str:
     """Send query to the backend and get response"""
     try:
         payload = format_messages_for_api(messages)
-        response = requests.post(RAG_QUERY_ENDPOINT, json=payload, timeout=30)
+        response = st.session_state.http.post(RAG_QUERY_ENDPOINT, json=payload)
         response.raise_for_status()
         
-        result = response.json()
+        result = orjson.loads(response.content)
         if "error" in result:
             return f"Error: {result['error']}"
         return result.get("response", "No response received")
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return f"Connection error: {str(e)}"
     except json.JSONDecodeError:
         return "Error: Invalid response format"
@@ -60,19 +56,17 @@ def stream_query(messages: List[Dict[str, str]]):
     """Stream query to the backend and yield chunks"""
     try:
         payload = format_messages_for_api(messages)
-        response = requests.post(
-            RAG_STREAM_ENDPOINT, 
-            json=payload, 
-            stream=True, 
-            timeout=30
-        )
-        response.raise_for_status()
-        
-        for chunk in response.iter_content(chunk_size=1, decode_unicode=True):
-            if chunk:
-                yield chunk
+        with st.session_state.http.stream("POST", RAG_STREAM_ENDPOINT, json=payload) as response:
+            response.raise_for_status()
+            
+            # Server-Sent Events: each "data:" line holds a JSON array of chunks
+            for line in response.iter_lines():
+                if line and line.startswith("data:"):
+                    chunks = orjson.loads(line[len("data:"):])
+                    if chunks:
+                        yield "".join(chunks)
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         yield f"Connection error: {str(e)}"
     except Exception as e:
         yield f"Unexpected error: {str(e)}"
@@ -86,6 +80,10 @@ if "messages" not in st.session_state:
 if "use_streaming" not in st.session_state:
     st.session_state.use_streaming = True
 
+# One pooled client per session so turns reuse the backend connection
+if "http" not in st.session_state:
+    st.session_state.http = httpx.Client(http2=True, timeout=30)
+
 # ----------------------
 # Sidebar Configuration
 # ----------------------
@@ -118,12 +116,12 @@ with st.sidebar:
     st.subheader("🔗 Connection Test")
     if st.button("Test Backend Connection"):
         try:
-            test_response = requests.get(f"{backend_url}/docs", timeout=5)
+            test_response = st.session_state.http.get(f"{backend_url}/docs", timeout=5)
             if test_response.status_code == 200:
                 st.success("✅ Backend is reachable!")
             else:
                 st.error(f"❌ Backend returned status: {test_response.status_code}")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             st.error(f"❌ Cannot reach backend: {str(e)}")
     
     # Clear chat
@@ -184,13 +182,15 @@ if prompt := st.chat_input("Ask me anything about your knowledge base..."):
             # Streaming response
             message_placeholder = st.empty()
             full_response = ""
+            last_render = 0.0
             
             with st.spinner("Retrieving from knowledge base..."):
                 for chunk in stream_query(st.session_state.messages):
                     full_response += chunk
-                    # Display with cursor effect and format markdown properly
-                    message_placeholder.markdown(full_response + "▌")
-                    time.sleep(0.01)  # Small delay for visual effect
+                    # Re-render at most every 50ms so a fast backend isn't held back by the UI
+                    if time.monotonic() - last_render > 0.05:
+                        message_placeholder.markdown(full_response + "▌")
+                        last_render = time.monotonic()
             
             # Final response without cursor
             message_placeholder.markdown(full_response)